@@ -1,122 +1,168 @@
+import argparse
+import sys
 import requests
-from bs4 import BeautifulSoup
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 import pandas as pd
 import numpy as np
-import os
-import openpyxl
-import matplotlib.pyplot as plt
 import re
-import urllib.request
-from weasyprint import HTML
+import shutil
+from pathlib import Path
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import lxml.html
+from io import BytesIO, StringIO
+from concurrent.futures import ThreadPoolExecutor
+from weasyprint import HTML, default_url_fetcher
+
+parser = argparse.ArgumentParser(description='Scrape the IBPA yield curve and bond prices from PHEI.')
+parser.add_argument('--force', action='store_true',
+                    help="scrape again even if the workbooks for the page's date already exist")
+args = parser.parse_args()
 
 # Define the URL of the website
 url = "https://www.phei.co.id/Data/HPW-dan-Imbal-Hasil"
-
-response = requests.get(url)
+# Date shown next to the government bond benchmark curve, e.g. "4-Desember-2023"
+date_pattern = re.compile(r'_idIGSYC_tdTgl">[^<]{0,100}?(\d{1,2})-([A-Za-z]+)-(\d{4})')
+
+# One keep-alive session for the page, the chart image and the PDF,
+# retrying transient server errors instead of failing the whole workflow
+retries = Retry(total=3, backoff_factor=1, status_forcelist=(500, 502, 503, 504),
+                allowed_methods=('GET', 'HEAD'))
+session = requests.Session()
+timeout = 30
+session.mount('https://', HTTPAdapter(max_retries=retries, pool_connections=4, pool_maxsize=4))
+
+response = session.get(url, timeout=timeout)
+response.raise_for_status()
 html_response = response.content
 text_find = response.text
-df_list = pd.read_html(html_response)
 
 # Find Date in Website
-count = 0
-for i in range(70):
-    try :
-        a = text_find[i*1000:(i+1)*1000].find('<div id="dnn_ctr1477_GovernmentBondBenchmark_idIGSYC_tdTgl">')
-        if a != -1:
-            save_multiplier = i
-            save_first = a
-            print(save_first, save_multiplier)
-    except :
-        count +=1
-
-date_yc = text_find[save_first+save_multiplier*1000 :100+save_first+save_multiplier*1000]
-date_yc = date_yc.split(' ')[-2]
-split = date_yc.find('<')
-clean_date = date_yc[:split]
-
-if int(clean_date.split('-')[0]) < 10:
-    cleaner_date = clean_date.split('-')
-    cleaner_date[0] = '0' + cleaner_date[0]
-    clean_date = '-'.join(cleaner_date)
-
-sub_path = f'Scrape PHEI/{clean_date.split("-")[2]}-{clean_date.split("-")[1]}'
-try:
-    os.makedirs(sub_path)
-    print(f"Folder {sub_path} created!")
-except FileExistsError:
-    print(f"Folder {sub_path} already exists")
-
-sub_path_image = sub_path+'/image'
-try:
-    os.makedirs(sub_path_image)
-    print(f"Folder {sub_path_image} created!")
-except FileExistsError:
-    print(f"Folder {sub_path_image} already exists")
-
-sub_path_py_image = sub_path+'/py-image'
-try:
-    os.makedirs(sub_path_py_image)
-    print(f"Folder {sub_path_py_image} created!")
-except FileExistsError:
-    print(f"Folder {sub_path_py_image} already exists")
-
-sub_path_pdf = sub_path+'/pdf'
-try:
-    os.makedirs(sub_path_pdf)
-    print(f"Folder {sub_path_pdf} created!")
-except FileExistsError:
-    print(f"Folder {sub_path_pdf} already exists")
-
-# Save as PDF
-HTML(url).write_pdf(f'Scrape PHEI/{clean_date.split("-")[2]}-{clean_date.split("-")[1]}/pdf/{clean_date}.pdf')
+date_match = date_pattern.search(text_find)
+if date_match is None:
+    sys.exit("Yield curve date not found in the benchmark date div")
+day, month_name, year = date_match.groups()
+clean_date = f'{int(day):02d}-{month_name}-{year}'
+
+sub_path = Path(f'Scrape PHEI/{year}-{month_name}')
+sub_path_image = sub_path / 'image'
+sub_path_py_image = sub_path / 'py-image'
+sub_path_pdf = sub_path / 'pdf'
+bond_data_path = sub_path / f'Bond-Data-{clean_date}.xlsx'
+yield_curve_path = sub_path / f'Yield-Curve-{clean_date}.xlsx'
+pdf_path = sub_path_pdf / f'{clean_date}.pdf'
+chart_path = sub_path_image / f'{clean_date}.jpeg'
+plot_path = sub_path_py_image / f'{clean_date}.jpeg'
+
+# The site only changes once per business day, so skip dates already scraped
+outputs = (bond_data_path, yield_curve_path, pdf_path, chart_path, plot_path)
+if all(output.exists() for output in outputs) and not args.force:
+    print(f"Data for {clean_date} already scraped, skipping")
+    sys.exit(0)
+
+for folder in (sub_path_image, sub_path_py_image, sub_path_pdf):
+    folder.mkdir(parents=True, exist_ok=True)
+
+# Let WeasyPrint pull stylesheets and images through the shared session
+def fetch_url(asset_url):
+    if not asset_url.startswith(('http://', 'https://')):
+        return default_url_fetcher(asset_url)
+    asset = session.get(asset_url, timeout=timeout)
+    asset.raise_for_status()
+    # Only pass a charset the server declared, as WeasyPrint's own fetcher
+    # does; requests' ISO-8859-1 fallback would override @charset/BOM sniffing
+    mime_type, *params = [part.strip() for part in asset.headers.get('Content-Type', '').split(';')]
+    charset = next((param.split('=', 1)[1].strip('"\'') for param in params
+                    if param.lower().startswith('charset=')), None)
+    return {'string': asset.content,
+            'mime_type': mime_type or None,
+            'encoding': charset,
+            'redirected_url': asset.url}
+
+# Save as PDF (rendered in the background while the rest of the page is processed)
+pdf_executor = ThreadPoolExecutor(max_workers=1)
+pdf_job = pdf_executor.submit(HTML(file_obj=BytesIO(html_response), base_url=response.url, url_fetcher=fetch_url).write_pdf,
+                              pdf_path)
 
 # Save image from Website
-img_location_url = text_find[re.search('ChartPic', text_find).start():re.search('ChartPic', text_find).start()+200].split(' ')[0][:-1]
+chart_idx = text_find.find('ChartPic')
+if chart_idx == -1:
+    sys.exit("Chart image link ('ChartPic') not found on the page")
+img_location_url = text_find[chart_idx:chart_idx+200].split(' ', 1)[0][:-1]
 imgURL = "https://www.phei.co.id/"+img_location_url
-urllib.request.urlretrieve(imgURL,f'Scrape PHEI/{clean_date.split("-")[2]}-{clean_date.split("-")[1]}/image/{clean_date}.jpeg')
+with session.get(imgURL, stream=True, timeout=timeout) as img_response:
+    img_response.raise_for_status()
+    if not img_response.headers.get('Content-Type', '').startswith('image/'):
+        sys.exit(f"Chart URL {imgURL} did not return an image")
+    img_response.raw.decode_content = True
+    with open(chart_path, 'wb') as f:
+        shutil.copyfileobj(img_response.raw, f)
+
+# Parse the page once and hand pandas one <table> at a time, stopping
+# after the first `count` tables that hold data
+def read_tables(html, count):
+    tables = []
+    for table in lxml.html.fromstring(html).xpath('//table'):
+        try:
+            frames = pd.read_html(StringIO(lxml.html.tostring(table, encoding='unicode')), flavor='lxml')
+        except ValueError:
+            continue
+        # Whitespace-only (spacer) tables come back as an empty list
+        if not frames:
+            continue
+        tables.append(frames[0])
+        if len(tables) == count:
+            break
+    return tables
+
+# Yield curve (0-1) followed by the SBN, SBSN and retail bond tables (2-4)
+df_list = read_tables(html_response, 5)
 
 def prepare_data(df, type_df):
-    copy_df = df.copy()
-    copy_df.drop(columns = copy_df.columns[[0, -1]], inplace = True)
-    copy_df['type'] = type_df
-    return copy_df
-
-sbn_data = prepare_data(df_list[2], 'sbn')
-sbsn_data = prepare_data(df_list[3], 'sbsn')
-retail_data= prepare_data(df_list[4], 'retail')
-
-bond_data = pd.concat((sbn_data, 
-                             sbsn_data,
-                             retail_data), axis = 0).reset_index(drop = True)
-
-bond_data.iloc[:,1] /= 100
-bond_data.iloc[:,2:-1] /= 10000
-bond_data.to_excel(f'Scrape PHEI/{clean_date.split("-")[2]}-{clean_date.split("-")[1]}/Bond-Data-{clean_date}.xlsx', 
-            sheet_name=clean_date)
-
-df = pd.concat((df_list[0],df_list[1]), axis = 0)[['Tenor Year', 'Today']]
-df['Tenor Year'] /= 10
-df['Today'] /= 1e6
-df.rename(columns = {'Today': 'IBPA Yield'}, inplace = True)
-df.set_index('Tenor Year', inplace=True)
+    return df.iloc[:, 1:-1].assign(type = type_df)
+
+bond_data = pd.concat([prepare_data(df_list[i], type_df)
+                       for i, type_df in zip((2, 3, 4), ('sbn', 'sbsn', 'retail'))],
+                      axis = 0, ignore_index = True)
+
+# TTM is quoted in 1/100 years, yields/prices/coupon in 1/10000 percent
+value_cols = bond_data.columns[1:-1]
+scales = np.array([100.] + [10000.]*(len(value_cols)-1))
+bond_data[value_cols] = bond_data[value_cols].to_numpy(dtype=np.float64) / scales
+bond_data.to_excel(bond_data_path, 
+            sheet_name=clean_date, engine='xlsxwriter')
+
+# Tenor is quoted in 1/10 years and the yield in 1e-6 units
+curve = pd.concat((df_list[0],df_list[1]), axis = 0)[['Tenor Year', 'Today']].to_numpy(dtype=np.float64) / np.array([10., 1e6])
+df = pd.DataFrame({'IBPA Yield': curve[:, 1]}, index = pd.Index(curve[:, 0], name = 'Tenor Year'))
 
 def spot_rate(df):
-    spot_data = df.values.copy()
-    for j in range(2,df.shape[0]):
-        minus = 0
-        for k in range(1,j):
-            minus -= spot_data[j]/(1+spot_data[k])**k
-        spot_data[j] = ((1+df.iloc[j])/(1+minus))**(1/j)-1
+    tenors = df.index.values.astype(np.float64)
+    yields = df.values.ravel().astype(np.float64)
+    spot_data = yields.copy()
+    # Running sum of discount factors, so each coupon PV is one multiply
+    annuity = (1+spot_data[1])**-tenors[1]
+    for j in range(2,yields.shape[0]):
+        discount = (1-yields[j]*annuity)/(1+yields[j])
+        spot_data[j] = discount**(-1/tenors[j])-1
+        annuity += discount
     return spot_data
 
 df['Spot-Rate'] = spot_rate(df)
 
-plt.plot(df.index, df['IBPA Yield'], label = 'Yield Curve')
-plt.plot(df.index, df['Spot-Rate'], label = 'Spot Rate')
-plt.legend()
-plt.title(f'YCB and ZCB IDR {clean_date}')
-plt.grid()
-plt.savefig(f'Scrape PHEI/{clean_date.split("-")[2]}-{clean_date.split("-")[1]}/py-image/{clean_date}.jpeg')
+fig, ax = plt.subplots()
+ax.plot(df.index, df['IBPA Yield'], label = 'Yield Curve')
+ax.plot(df.index, df['Spot-Rate'], label = 'Spot Rate')
+ax.legend()
+ax.set_title(f'YCB and ZCB IDR {clean_date}')
+ax.grid()
+fig.savefig(plot_path)
+plt.close(fig)
+
+df.to_excel(yield_curve_path, 
+            sheet_name=clean_date, engine='xlsxwriter')
 
-df.to_excel(f'Scrape PHEI/{clean_date.split("-")[2]}-{clean_date.split("-")[1]}/Yield-Curve-{clean_date}.xlsx', 
-            sheet_name=clean_date)
\ No newline at end of file
+pdf_job.result()
+pdf_executor.shutdown()